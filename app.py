@@ -1,15 +1,29 @@
 # app.py
 import streamlit as st
 import google.generativeai as genai
+from google.generativeai import caching
 import pandas as pd
-from sqlalchemy import create_engine, text, inspect  # <-- Make sure 'inspect' is here
+from sqlalchemy import create_engine, text
 from duckduckgo_search import DDGS
 import os
+import re
+import logging
+import time
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain, zip_longest
+from typing import Iterator, Union
 import json
+import hashlib
+import datetime
 from dotenv import load_dotenv
 
 # --- 1. Configuration and Setup ---
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables (your GEMINI_API_KEY)
 load_dotenv()
 
@@ -21,24 +35,120 @@ DB_HOST = "localhost"
 DB_PORT = "3306"
 DB_NAME = "olist_db"
 
+# Connection pool, shared by all Streamlit sessions
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_RECYCLE_SECONDS = 1800
+
+# The app's own read-only queries (schema, map) run in autocommit mode, without
+# transaction bookkeeping. LLM-written SQL never does; see _execute_sql.
+READ_ONLY_OPTIONS = {"isolation_level": "AUTOCOMMIT"}
+
+# Written by load_data.py; read instead of introspecting the database
+SCHEMA_JSON_PATH = "schema.json"
+
 # Configure the Gemini API
+GEMINI_MODEL_NAME = 'gemini-2.5-pro'
+# Routing is a small classification task, so it runs on the faster Flash model
+ROUTER_MODEL_NAME = 'gemini-2.5-flash'
+
 try:
     genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-    # This is the NEW, corrected line
-    # This is the NEW, corrected line
-    GEMINI_MODEL = genai.GenerativeModel('gemini-2.5-pro')
+    GEMINI_MODEL = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    ROUTER_MODEL = genai.GenerativeModel(ROUTER_MODEL_NAME)
 except Exception as e:
     st.error(f"Error configuring Gemini: {e}. Is your GEMINI_API_KEY set in .env?")
     st.stop()
 
+# Streamed replies are kept this long, so repeated prompts skip the API
+STREAM_CACHE_TTL_SECONDS = 3600
+STREAM_CACHE_MAX_ENTRIES = 512
+# The finish reason of a reply that ended normally
+STOP_FINISH_REASON = genai.protos.Candidate.FinishReason.STOP
+
+class StreamReplyCache:
+    """
+    A small thread-safe LRU of finished streamed replies, keyed by prompt.
+    st.cache_data can't wrap a generator, so streamed text is stored here
+    once the stream has completed.
+    """
+
+    def __init__(self, ttl: float = STREAM_CACHE_TTL_SECONDS, max_entries: int = STREAM_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._replies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, prompt: str):
+        with self._lock:
+            entry = self._replies.get(prompt)
+            if entry is None:
+                return None
+            stored_at, text = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._replies[prompt]
+                return None
+            self._replies.move_to_end(prompt)
+            return text
+
+    def put(self, prompt: str, text: str):
+        with self._lock:
+            self._replies[prompt] = (time.monotonic(), text)
+            self._replies.move_to_end(prompt)
+            while len(self._replies) > self.max_entries:
+                self._replies.popitem(last=False)
+
+@st.cache_resource
+def get_stream_cache() -> StreamReplyCache:
+    """One reply cache per process, shared by every session."""
+    return StreamReplyCache()
+
+def _gemini_stream(prompt: str, error_message: str) -> Iterator[str]:
+    """
+    Streams the Gemini response text chunk by chunk, for st.write_stream.
+    A prompt that was streamed before is replayed from the cache instead.
+    Errors are yielded as text, since the reply may already be half on
+    screen when they happen, and are never cached, nor are empty or
+    unfinished replies.
+    """
+    stream_cache = get_stream_cache()
+    cached_reply = stream_cache.get(prompt)
+    if cached_reply is not None:
+        yield cached_reply
+        return
+
+    chunks = []
+    finish_reason = None
+    try:
+        for chunk in GEMINI_MODEL.generate_content(prompt, stream=True):
+            if chunk.parts:
+                chunks.append(chunk.text)
+                yield chunks[-1]
+            if chunk.candidates and chunk.candidates[0].finish_reason:
+                finish_reason = chunk.candidates[0].finish_reason
+    except Exception as e:
+        yield f"{error_message}: {e}"
+        return
+    # Only complete replies are cached; an empty, blocked or truncated one
+    # (finish reason SAFETY, MAX_TOKENS, ...) is retried next time
+    if chunks and finish_reason == STOP_FINISH_REASON:
+        stream_cache.put(prompt, "".join(chunks))
+
 # --- 2. Database Connection and Schema ---
 
 @st.cache_resource
 def get_db_connection():
     """Establishes a connection to the MySQL database."""
     try:
-        connection_string = f"mysql+mysqlconnector://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-        engine = create_engine(connection_string)
+        # PyMySQL supports server-side cursors (stream_results); mysql-connector doesn't
+        connection_string = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+        engine = create_engine(
+            connection_string,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_pre_ping=True,  # Replace sockets MySQL closed while idle
+            pool_recycle=DB_POOL_RECYCLE_SECONDS,
+        )
         return engine
     except Exception as e:
         st.error(f"Failed to connect to MySQL database: {e}")
@@ -47,18 +157,29 @@ def get_db_connection():
 @st.cache_data
 def get_db_schema(_engine):
     """
-    Introspects the database and returns a simplified schema string.
+    Returns a simplified schema string.
     This schema is what the LLM will use to write queries.
+    Uses the schema.json written by load_data.py if present, otherwise
+    reads every table's columns with a single information_schema query.
+    The map's pre-computed olist_customer_locations table is left out either way.
     """
-    # Use the new SQLAlchemy inspect function
-    inspector = inspect(_engine) 
+    try:
+        with open(SCHEMA_JSON_PATH) as f:
+            tables = json.load(f)
+    except (OSError, ValueError):
+        schema_query = text("""
+            SELECT TABLE_NAME, COLUMN_NAME
+            FROM information_schema.columns
+            WHERE TABLE_SCHEMA = :db AND TABLE_NAME <> 'olist_customer_locations'
+            ORDER BY TABLE_NAME, ORDINAL_POSITION
+        """)
+        tables = {}
+        with _engine.connect().execution_options(**READ_ONLY_OPTIONS) as conn:
+            for table, column in conn.execute(schema_query, {"db": DB_NAME}):
+                tables.setdefault(table, []).append(column)
     
     schema_info = []
-    tables = inspector.get_table_names()
-    
-    for table in tables:
-        columns = inspector.get_columns(table)
-        col_names = [col['name'] for col in columns]
+    for table, col_names in tables.items():
         schema_info.append(f"Table: {table}, Columns: {', '.join(col_names)}")
     
     return "\n".join(schema_info)
@@ -66,23 +187,21 @@ def get_db_schema(_engine):
 # Initialize connection and get schema
 engine = get_db_connection()
 DB_SCHEMA = get_db_schema(engine)
+# Part of the cache key for generated SQL, so a schema change invalidates it
+SCHEMA_HASH = hashlib.md5(DB_SCHEMA.encode()).hexdigest()
 
 
 # --- 3. Tool Definitions (The "Agentic" Part) ---
 
-def run_sql_agent(query_prompt: str, chat_history: list) -> str:
-    """
-    Tool 1: Text-to-SQL Agent
-    Takes a natural language query, generates SQL, executes it, 
-    and returns a natural language summary of the results.
-    """
-    st.write("🤖 Thinking in SQL...")
+# SQL results are streamed in chunks; only a preview is ever sent to the LLM.
+SQL_CHUNK_SIZE = 1000
+SQL_PREVIEW_ROWS = 50
+# Generated SQL must be a query: SELECT or WITH, optionally after comments
+READ_ONLY_SQL_RE = re.compile(r"^\s*(?:(?:--[^\n]*\n|/\*.*?\*/)\s*)*(select|with)\b", re.I | re.S)
 
-    # --- Step 3a: Generate SQL Query ---
-    formatted_history = format_chat_history_for_prompt(chat_history)
-    
-    # !!! THIS PROMPT IS NOW FIXED !!!
-    sql_prompt = f"""
+# The static part of the SQL prompt (schema and rules), built once at startup.
+# Only the question is added per call.
+SQL_PROMPT_PREFIX = f"""
     You are an expert MySQL database analyst.
     Your task is to generate a single, executable MySQL query to answer the user's question.
     
@@ -97,30 +216,125 @@ def run_sql_agent(query_prompt: str, chat_history: list) -> str:
     - If a query is complex, use Common Table Expressions (CTEs) for clarity.
     - The `product_category_name_translation` table translates Portuguese category names. 
       You MUST join with it (on `product_category_name`) to show English names.
-    
-    CHAT HISTORY (for context):
-    {formatted_history}
-    
+"""
+
+# How long Gemini keeps the cached SQL prefix. The app builds a new cached
+# prefix a few minutes before the old one expires.
+SQL_CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+# Gemini won't cache less than this many tokens for gemini-2.5-pro
+SQL_CONTEXT_CACHE_MIN_TOKENS = 4096
+# Rough size estimate, to avoid a doomed API call for small schemas
+CHARS_PER_TOKEN = 4
+
+@st.cache_resource(ttl=SQL_CONTEXT_CACHE_TTL - datetime.timedelta(minutes=5), show_spinner=False)
+def get_sql_model():
+    """
+    Returns (model, prefix_is_cached) for SQL generation.
+    If SQL_PROMPT_PREFIX is big enough for Gemini's explicit caching, it is
+    uploaded once as cached content, so each call only sends (and pays full
+    price for) the question. Smaller prefixes, like the Olist schema's
+    ~600 tokens, are sent with every call on the normal model.
+    """
+    estimated_tokens = len(SQL_PROMPT_PREFIX) // CHARS_PER_TOKEN
+    if estimated_tokens < SQL_CONTEXT_CACHE_MIN_TOKENS:
+        logger.info(
+            "SQL prompt prefix is ~%d tokens, below the %d-token context caching minimum; not caching it.",
+            estimated_tokens, SQL_CONTEXT_CACHE_MIN_TOKENS,
+        )
+        return GEMINI_MODEL, False
+
+    try:
+        cache = caching.CachedContent.create(
+            model=f"models/{GEMINI_MODEL_NAME}",
+            display_name="olist-sql-prompt-prefix",
+            contents=[SQL_PROMPT_PREFIX],
+            ttl=SQL_CONTEXT_CACHE_TTL,
+        )
+        return genai.GenerativeModel.from_cached_content(cached_content=cache), True
+    except Exception as e:
+        logger.warning("Could not create the Gemini context cache for the SQL prefix: %s", e)
+        return GEMINI_MODEL, False
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _nl_to_sql(question: str, schema_hash: str) -> str:
+    """
+    Asks Gemini to write the MySQL query for a standalone question.
+    Cached per (question, schema) so a repeated question skips the LLM call.
+    """
+    sql_prompt_suffix = f"""
     USER'S QUESTION:
-    "{query_prompt}"
+    "{question}"
     
     MySQL QUERY:
     ```sql
     """
-    
+    sql_model, prefix_is_cached = get_sql_model()
+    if not prefix_is_cached:
+        sql_prompt_suffix = SQL_PROMPT_PREFIX + sql_prompt_suffix
+    return sql_model.generate_content(sql_prompt_suffix).text
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _execute_sql(sql_query: str):
+    """
+    Streams the results of a query with a server-side cursor.
+    Returns the first few rows, the total row count and per-column numeric
+    stats (count, sum, min, max), without holding the full result in memory.
+    Cached per query, so a repeated question skips the database round trip.
+    The SQL is written by the LLM, so only SELECT/WITH statements are run,
+    inside a read-only transaction that is rolled back afterwards.
+    """
+    if not READ_ONLY_SQL_RE.match(sql_query):
+        raise ValueError("only SELECT queries can be run")
+
+    preview_df = None
+    total_rows = 0
+    stats = {"count": pd.Series(dtype="float64"), "sum": pd.Series(dtype="float64"),
+             "min": pd.Series(dtype="float64"), "max": pd.Series(dtype="float64")}
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True, max_row_buffer=SQL_CHUNK_SIZE)
+        # Any write that gets past the check above fails here instead of being committed
+        conn.exec_driver_sql("START TRANSACTION READ ONLY")
+        for chunk in pd.read_sql(text(sql_query), conn, chunksize=SQL_CHUNK_SIZE):
+            if preview_df is None:
+                preview_df = chunk.head(SQL_PREVIEW_ROWS)
+            total_rows += len(chunk)
+
+            numeric = chunk.select_dtypes("number")
+            stats["count"] = stats["count"].add(numeric.count(), fill_value=0)
+            stats["sum"] = stats["sum"].add(numeric.sum(), fill_value=0)
+            stats["min"] = pd.concat([stats["min"], numeric.min()], axis=1).min(axis=1)
+            stats["max"] = pd.concat([stats["max"], numeric.max()], axis=1).max(axis=1)
+
+    if preview_df is None:
+        preview_df = pd.DataFrame()
+    return preview_df, total_rows, pd.DataFrame(stats)
+
+def run_sql_agent(query_prompt: str) -> Union[str, Iterator[str]]:
+    """
+    Tool 1: Text-to-SQL Agent
+    Takes a natural language query, generates SQL, executes it, 
+    and streams a natural language summary of the results.
+    """
+    st.write("🤖 Thinking in SQL...")
+
+    # --- Step 3a: Generate SQL Query ---
     try:
-        response = GEMINI_MODEL.generate_content(sql_prompt)
-        sql_query = response.text.strip().replace("```sql", "").replace("```", "")
-        st.code(sql_query, language="sql")
+        sql_query = _nl_to_sql(query_prompt, SCHEMA_HASH)
     except Exception as e:
         return f"Error generating SQL: {e}"
 
+    sql_query = sql_query.strip().replace("```sql", "").replace("```", "")
+    st.code(sql_query, language="sql")
+
     # --- Step 3b: Execute SQL Query ---
     try:
-        with engine.connect() as conn:
-            result_df = pd.read_sql(text(sql_query), conn)
-            result_json = result_df.to_json(orient="records")
+        preview_df, total_rows, stats_df = _execute_sql(sql_query)
+        result_preview = preview_df.head(SQL_PREVIEW_ROWS).to_csv(index=False)
+        stats_preview = stats_df.to_csv()
     except Exception as e:
+        # Don't keep serving a query that doesn't run; the next ask regenerates it
+        _nl_to_sql.clear(query_prompt, SCHEMA_HASH)
         return f"Error executing SQL: {e}. Query was: {sql_query}"
 
     # --- Step 3c: Summarize Results ---
@@ -129,22 +343,57 @@ def run_sql_agent(query_prompt: str, chat_history: list) -> str:
     You are a helpful data analyst.
     The user asked this question: "{query_prompt}"
     
-    We ran a SQL query and got this data (in JSON format):
-    {result_json}
+    We ran a SQL query. Total rows: {total_rows}
+    Here are the first {len(preview_df)} rows (in CSV format):
+    {result_preview}
+    
+    Column statistics over all {total_rows} rows (count, sum, min, max of numeric columns, in CSV format):
+    {stats_preview}
     
     Please provide a concise, natural language answer to the user's question based *only* on this data.
-    - Do not mention the SQL query or JSON.
+    - Do not mention the SQL query or CSV.
     - If the data is a single number or list, present it cleanly.
     - If the data is a table, summarize the key findings.
     """
     
-    try:
-        summary_response = GEMINI_MODEL.generate_content(summary_prompt)
-        return summary_response.text
-    except Exception as e:
-        return f"Error summarizing results: {e}"
+    return _gemini_stream(summary_prompt, "Error summarizing results")
+
+# DuckDuckGo regions searched concurrently: worldwide, and Brazil for Olist-specific topics
+WEB_SEARCH_REGIONS = ["wt-wt", "br-pt"]
+WEB_RESULTS_PER_REGION = 5
+WEB_MAX_SNIPPETS = 8
+
+def _search_region(query_prompt: str, region: str) -> list:
+    """Runs one DuckDuckGo search. Each call uses its own DDGS session, so it is thread-safe."""
+    with DDGS() as ddgs:
+        return list(ddgs.text(query_prompt, region=region, max_results=WEB_RESULTS_PER_REGION))
+
+def search_web(query_prompt: str) -> list:
+    """
+    Searches all WEB_SEARCH_REGIONS at the same time and merges the results,
+    alternating between regions and dropping duplicate links.
+    """
+    with ThreadPoolExecutor(max_workers=len(WEB_SEARCH_REGIONS)) as executor:
+        futures = [executor.submit(_search_region, query_prompt, region) for region in WEB_SEARCH_REGIONS]
+
+    region_results, errors = [], []
+    for future in futures:
+        try:
+            region_results.append(future.result())
+        except Exception as e:
+            errors.append(e)
+    if errors and not region_results:
+        raise errors[0]
 
-def run_web_agent(query_prompt: str) -> str:
+    merged, seen_links = [], set()
+    for result in chain.from_iterable(zip_longest(*region_results)):
+        if result is None or result.get("href") in seen_links:
+            continue
+        seen_links.add(result.get("href"))
+        merged.append(result)
+    return merged[:WEB_MAX_SNIPPETS]
+
+def run_web_agent(query_prompt: str) -> Union[str, Iterator[str]]:
     """
     Tool 2: Web Search Agent
     Uses DuckDuckGo to search the web for external information.
@@ -152,8 +401,7 @@ def run_web_agent(query_prompt: str) -> str:
     st.write("🤖 Searching the web...")
     
     try:
-        with DDGS() as ddgs:
-            search_results = list(ddgs.text(query_prompt, max_results=5))
+        search_results = search_web(query_prompt)
         
         if not search_results:
             return "I couldn't find anything on the web for that query."
@@ -172,11 +420,37 @@ def run_web_agent(query_prompt: str) -> str:
         Cite the snippet numbers if you want, but it's not required.
         """
         
-        summary_response = GEMINI_MODEL.generate_content(summary_prompt)
-        return summary_response.text
+        return _gemini_stream(summary_prompt, "Error during web search")
     except Exception as e:
         return f"Error during web search: {e}"
 
+# Well above the ~4,500 cells in the Olist data, well below MapLibre's 32k point limit
+MAP_MAX_POINTS = 10000
+# Point radius in meters per sqrt(customer count), so point area grows with the count
+MAP_POINT_SIZE_METERS = 300
+
+@st.cache_resource(show_spinner=False)
+def _map_df() -> pd.DataFrame:
+    """
+    Fetches the customer locations for the map.
+    The geolocation data is static, so this runs once per process
+    and every session shares the same DataFrame.
+    """
+    # Customer counts per ~0.1 degree cell, pre-computed by load_data.py,
+    # so only one point per cell is sent to the map
+    # If the cap is ever hit, the busiest cells are the ones kept
+    map_query = f"""
+    SELECT lat, lon, n
+    FROM `olist_customer_locations`
+    ORDER BY n DESC
+    LIMIT {MAP_MAX_POINTS};
+    """
+    with engine.connect().execution_options(**READ_ONLY_OPTIONS) as conn:
+        map_df = pd.read_sql(text(map_query), conn)
+
+    map_df["size"] = map_df["n"].astype("float64") ** 0.5 * MAP_POINT_SIZE_METERS
+    return map_df
+
 def run_map_agent() -> str:
     """
     Tool 3: Map Plotting Agent
@@ -185,47 +459,29 @@ def run_map_agent() -> str:
     st.write("🤖 Generating map of customer locations...")
     
     try:
-        # A simple query to get a sample of customer locations
-        map_query = """
-        SELECT 
-            geo.geolocation_lat,
-            geo.geolocation_lng
-        FROM 
-            `olist_customers_dataset.csv` c
-        JOIN 
-            `olist_geolocation_dataset.csv` geo 
-        ON 
-            c.customer_zip_code_prefix = geo.geolocation_zip_code_prefix
-        LIMIT 2000;
-        """
-        with engine.connect() as conn:
-            map_df = pd.read_sql(text(map_query), conn)
-        
-        # Rename for st.map
-        map_df.rename(columns={'geolocation_lat': 'lat', 'geolocation_lng': 'lon'}, inplace=True)
+        map_df = _map_df()
         
         # Display the map in Streamlit
-        st.map(map_df, zoom=3)
-        return "Here is a map showing the locations of 2,000 sample customers."
+        st.map(map_df, size="size", zoom=3)
+        return f"Here is a map showing customer locations, grouped into {len(map_df):,} areas."
         
     except Exception as e:
         return f"Error generating map: {e}"
 
-def run_chat_agent(query_prompt: str, chat_history: list) -> str:
+CHAT_PROMPT_PREFIX = """
+    You are a friendly and helpful conversational AI.
+"""
+
+def run_chat_agent(query_prompt: str, history_prompt: str) -> Iterator[str]:
     """
     Tool 4: General Chat Agent
     For holding a normal conversation.
     """
     st.write("🤖 Just chatting...")
     
-    # !!! THIS IS THE FIX !!!
-    formatted_history = format_chat_history_for_prompt(chat_history)
-    
-    prompt = f"""
-    You are a friendly and helpful conversational AI.
-    
+    prompt = CHAT_PROMPT_PREFIX + f"""
     CHAT HISTORY (for context):
-    {formatted_history}
+    {history_prompt}
     
     USER'S QUESTION:
     "{query_prompt}"
@@ -233,49 +489,77 @@ def run_chat_agent(query_prompt: str, chat_history: list) -> str:
     YOUR RESPONSE:
     """
     
-    try:
-        response = GEMINI_MODEL.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        return f"Error in chat: {e}"
+    return _gemini_stream(prompt, "Error in chat")
 
 # --- 4. NEW Helper Function for Chat History ---
 
-def format_chat_history_for_prompt(chat_history: list) -> str:
-    """Converts the chat history list of dicts to a simple string."""
-    if not chat_history:
-        return "No history yet."
-    
-    formatted_string = ""
-    # We only need the last few messages for context
-    for message in chat_history[-5:]: # Get last 5 messages
-        role = "User" if message['role'] == 'user' else "Assistant"
-        content = message['content'].replace('\n', ' ').strip()
-        formatted_string += f"{role}: {content}\n"
-    return formatted_string
-
-# --- 5. The Agent Orchestrator (Router) ---
+# How many past lines of conversation are kept in the prompt history.
+HISTORY_PROMPT_MAX_LINES = 8
 
-def get_agent_response(user_prompt: str, chat_history: list) -> str:
+def append_to_history_prompt(role: str, content: str) -> None:
     """
-    This is the main "Router" or "Orchestrator" agent.
-    It decides which tool to use based on the user's prompt.
+    Appends one message to the cached prompt history in session state.
+    Only the last few lines are kept, so the string never has to be rebuilt.
     """
-    
-    # This is the master prompt for the router.
-    # !!! THIS IS THE FIX !!!
-    formatted_history = format_chat_history_for_prompt(chat_history)
-    
-    router_prompt = f"""
+    cleaned = content.replace('\n', ' ').strip()
+    lines = st.session_state.history_prompt.split("\n")[-HISTORY_PROMPT_MAX_LINES:]
+    st.session_state.history_prompt = "\n".join(lines + [f"{role}: {cleaned}"])
+
+# --- 5. The Agent Orchestrator (Router) ---
+
+# The router answers in Gemini's JSON mode, so the tool choice and the
+# reply for small talk come back in a single call.
+ROUTER_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "tool": {
+            "type": "string",
+            "enum": ["sql_analyst", "web_search", "plot_map", "general_chat"],
+        },
+        "query": {"type": "string"},
+        "answer": {"type": "string"},
+    },
+    "required": ["tool", "query"],
+}
+
+ROUTER_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": ROUTER_RESPONSE_SCHEMA,
+}
+
+# Used when several sessions are routed in one call; "id" maps answers back to queries.
+# Batched calls only pick the tool: no "query" or "answer", so text written next to
+# another session's chat history can't leak into this session's tool call or reply.
+BATCH_ROUTER_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "id": {"type": "integer"},
+                "tool": ROUTER_RESPONSE_SCHEMA["properties"]["tool"],
+            },
+            "required": ["id", "tool"],
+        },
+    },
+}
+
+# The router only classifies, so it gets a one-line description of the
+# database instead of the full schema (SQL is written by _nl_to_sql on Pro)
+ROUTER_INSTRUCTIONS = """
     You are an AI agent orchestrator for an e-commerce data analysis chatbot.
-    Your job is to classify the user's query and select the *only* correct tool to answer it.
+    Your job is to classify the user's query, select the *only* correct tool to answer it,
+    and fill in everything that tool needs.
     
     You have the following tools:
     1.  **sql_analyst**: Use this for any question that requires analyzing the e-commerce database.
         Examples: "What are the top 5 selling products?", "Total revenue last quarter?", "Average review score?"
+        Put the full question in the "query" field, rewritten to stand on its own (resolve follow-ups using the chat history).
     
     2.  **web_search**: Use this for general knowledge, definitions, real-time information, or product details *not* in the database.
         Examples: "What is 'Olist'?", "Define 'average order value'", "What's the weather in Sao Paulo?"
+        Put the search engine query in the "query" field.
     
     3.  **plot_map**: Use this *only* when the user explicitly asks to see locations on a map.
         Examples: "Show me where my customers are", "Plot seller locations on a map"
@@ -283,14 +567,21 @@ def get_agent_response(user_prompt: str, chat_history: list) -> str:
     4.  **general_chat**: Use this for greetings, follow-ups, or when no other tool is appropriate.
         Examples: "Hello", "Thanks!", "Wow, that's cool", "What can you do?"
 
-    Given the chat history and the new user query, respond with a *single* JSON object 
-    indicating the tool to use and the query for that tool.
+    THE DATABASE holds the Olist Brazilian e-commerce data: orders, order items, payments,
+    reviews, products and their categories, customers, sellers and geolocation.
+"""
+
+def build_router_prompt(history_prompt: str, user_prompt: str) -> str:
+    """The master prompt for routing a single query."""
+    return ROUTER_INSTRUCTIONS + f"""
+    Given the chat history and the new user query, respond with a *single* JSON object.
+    If the tool is general_chat, you MUST also write your friendly, helpful reply to the user in the "answer" field.
     
-    JSON format: {{"tool": "tool_name", "query": "query_for_the_tool"}}
+    JSON format: {{"tool": "tool_name", "query": "query_for_the_tool", "answer": "general_chat only"}}
     
     ---
     CHAT HISTORY:
-    {formatted_history}
+    {history_prompt}
     
     NEW USER QUERY:
     "{user_prompt}"
@@ -299,32 +590,223 @@ def get_agent_response(user_prompt: str, chat_history: list) -> str:
     YOUR JSON RESPONSE:
     """
 
+def build_batch_router_prompt(requests: list) -> str:
+    """The master prompt for routing several independent (history, query) pairs at once."""
+    conversations = "\n".join(
+        f"""
+    --- CONVERSATION {i} ---
+    CHAT HISTORY:
+    {history_prompt}
+    
+    NEW USER QUERY:
+    "{user_prompt}"
+    """
+        for i, (history_prompt, user_prompt) in enumerate(requests)
+    )
+    return ROUTER_INSTRUCTIONS + f"""
+    Below are {len(requests)} unrelated conversations. Classify the new user query of each one
+    independently, using only that conversation's chat history.
+    Only pick the tool for each query; do not rewrite the queries or write replies to the users.
+    Respond with a JSON array containing one object per conversation.
+    
+    JSON format: [{{"id": conversation_number, "tool": "tool_name"}}]
+    {conversations}
+    YOUR JSON RESPONSE:
+    """
+
+def _parse_json(reply: str):
+    """Cleans and parses a JSON reply from the router."""
+    return json.loads(reply.strip().replace("```json", "").replace("```", ""))
+
+# Router requests from concurrent sessions arriving within this window share one Gemini call
+ROUTER_BATCH_WINDOW_SECONDS = 0.05
+ROUTER_MAX_BATCH_SIZE = 8
+
+class RouterBatcher:
+    """
+    Coalesces router requests from concurrent Streamlit sessions.
+    A background thread collects requests for a short window and sends them
+    to Gemini as one multi-query prompt, then hands each session its own answer.
+    When no routing call is in flight the request is sent right away, so
+    the idle case pays no batching delay; it uses the normal single-query
+    prompt. Batched calls only pick the tool; each session's tool then gets
+    its own query, and general_chat replies are written per session by the
+    chat agent.
+    """
+
+    def __init__(self, window: float = ROUTER_BATCH_WINDOW_SECONDS, max_batch_size: int = ROUTER_MAX_BATCH_SIZE):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._requests = queue.Queue()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        # Batches are sent from a pool, so a slow call doesn't hold up the next window
+        self._senders = ThreadPoolExecutor(max_workers=4)
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def route(self, history_prompt: str, user_prompt: str) -> dict:
+        """Blocks until this query's tool choice is ready."""
+        future = Future()
+        self._requests.put((history_prompt, user_prompt, future))
+        return future.result()
+
+    def _collect(self):
+        while True:
+            batch = [self._requests.get()]
+            with self._in_flight_lock:
+                idle = self._in_flight == 0
+            # Only wait for company when other routing calls are already running
+            deadline = time.monotonic() + (0 if idle else self.window)
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._requests.get(timeout=remaining))
+                    else:
+                        # Window over (or idle): still take anything already queued
+                        batch.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+            with self._in_flight_lock:
+                self._in_flight += 1
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch: list):
+        futures = [future for _, _, future in batch]
+        try:
+            if len(batch) == 1:
+                history_prompt, user_prompt, _ = batch[0]
+                response = ROUTER_MODEL.generate_content(
+                    build_router_prompt(history_prompt, user_prompt),
+                    generation_config=ROUTER_GENERATION_CONFIG,
+                )
+                futures[0].set_result(_parse_json(response.text))
+                return
+
+            response = ROUTER_MODEL.generate_content(
+                build_batch_router_prompt([(h, u) for h, u, _ in batch]),
+                generation_config=BATCH_ROUTER_GENERATION_CONFIG,
+            )
+            choices = {choice.get("id"): choice for choice in _parse_json(response.text)}
+            for i, (_, user_prompt, future) in enumerate(batch):
+                if i in choices:
+                    # Only the tool is taken from the shared call
+                    future.set_result({"tool": choices[i].get("tool"), "query": user_prompt})
+                else:
+                    future.set_exception(ValueError(f"the batched router returned no answer for query {i}"))
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight -= 1
+
+@st.cache_resource
+def get_router_batcher() -> RouterBatcher:
+    """One batcher per process, shared by every session."""
+    return RouterBatcher()
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def _route_cached(history_prompt: str, user_prompt: str) -> dict:
+    """Routes a query through the shared batcher; repeated (history, query) pairs are cached."""
+    return get_router_batcher().route(history_prompt, user_prompt)
+
+# Cheap local pre-router: obvious queries skip the LLM routing call.
+GREETING_RE = re.compile(r"^\s*(hi|hello|hey|thanks|thank you|bye)\b[\s!.]*$", re.I)
+# Greetings get a canned reply, without any Gemini call
+GREETING_REPLIES = {
+    "thanks": "You're welcome! Anything else you'd like to know about the Olist data?",
+    "thank you": "You're welcome! Anything else you'd like to know about the Olist data?",
+    "bye": "Goodbye! Come back any time you have questions about the Olist data.",
+}
+DEFAULT_GREETING_REPLY = (
+    "Hello! I can answer questions about the Olist orders, products, sellers and reviews, "
+    "search the web, or plot where the customers are on a map. What would you like to know?"
+)
+MAP_RE = re.compile(
+    r"\b(on a map|map of|show (me )?(a |the )?map)\b"
+    r"|\bplot\b.*\blocations?\b"
+    r"|^\s*(show me )?where (are )?(my|our|the) customers( are)?\s*[?.!]*\s*$",
+    re.I,
+)
+SQL_RE = re.compile(r"\b(top \d+|count|average|avg|how many|total|number of)\b", re.I)
+# A SQL keyword only counts when the question is about something in the database
+DB_NOUN_RE = re.compile(
+    r"\b(orders?|products?|sellers?|reviews?|customers?|payments?|categor(y|ies)|revenue|sales|freight|deliver(y|ies))\b",
+    re.I,
+)
+# Queries that look like web questions or lean on earlier messages stay with the LLM router
+WEB_HINT_RE = re.compile(r"\b(define|definition|meaning|what does|who is|weather|news)\b", re.I)
+FOLLOW_UP_RE = re.compile(
+    r"\b(those|these|that|them|it|they|same|previous|above|what about|how about|and|instead)\b", re.I
+)
+
+def classify_locally(user_prompt: str):
+    """
+    Picks a tool for trivial queries with regexes.
+    Returns None when the query is ambiguous, so the LLM router decides.
+    """
+    if GREETING_RE.match(user_prompt):
+        return "general_chat"
+    if WEB_HINT_RE.search(user_prompt) or FOLLOW_UP_RE.search(user_prompt):
+        return None
+
+    is_map = bool(MAP_RE.search(user_prompt))
+    is_sql = bool(SQL_RE.search(user_prompt) and DB_NOUN_RE.search(user_prompt))
+    if is_map and not is_sql:
+        return "plot_map"
+    if is_sql and not is_map:
+        return "sql_analyst"
+    return None
+
+def get_agent_response(user_prompt: str, history_prompt: str) -> Union[str, Iterator[str]]:
+    """
+    This is the main "Router" or "Orchestrator" agent.
+    It decides which tool to use based on the user's prompt and, in the
+    same call, writes the chat reply for small talk.
+    Returns either the final text or a stream of text chunks.
+    """
+    
+    # Obvious queries are routed locally, without a Gemini call
+    local_tool = classify_locally(user_prompt)
+    if local_tool == "sql_analyst":
+        return run_sql_agent(user_prompt)
+    elif local_tool == "plot_map":
+        return run_map_agent()
+    elif local_tool == "general_chat":
+        st.write("🤖 Just chatting...")
+        greeting = GREETING_RE.match(user_prompt).group(1).lower()
+        return GREETING_REPLIES.get(greeting, DEFAULT_GREETING_REPLY)
+
     try:
-        # Ask the LLM to choose a tool
-        response = GEMINI_MODEL.generate_content(router_prompt)
-        
-        # Clean and parse the JSON response
-        tool_choice_json = response.text.strip().replace("```json", "").replace("```", "")
-        tool_choice = json.loads(tool_choice_json)
+        # Ask the LLM to choose a tool (batched with other sessions if they route at the same time)
+        tool_choice = _route_cached(history_prompt, user_prompt)
         
         tool = tool_choice.get("tool")
-        query_for_tool = tool_choice.get("query")
+        query_for_tool = tool_choice.get("query") or user_prompt
 
         # --- Call the chosen tool ---
         if tool == "sql_analyst":
-            return run_sql_agent(query_for_tool, chat_history)
+            return run_sql_agent(query_for_tool)
         elif tool == "web_search":
             return run_web_agent(query_for_tool)
         elif tool == "plot_map":
             return run_map_agent()
         elif tool == "general_chat":
-            return run_chat_agent(query_for_tool, chat_history)
+            # The reply was written in the routing call; fall back to the chat
+            # agent if it is missing (batched routing calls never write one).
+            answer = tool_choice.get("answer")
+            if answer:
+                st.write("🤖 Just chatting...")
+                return answer
+            return run_chat_agent(query_for_tool, history_prompt)
         else:
             return f"Error: The router selected an invalid tool ('{tool}')."
             
-    except json.JSONDecodeError:
-        st.error(f"Error: The agent's routing decision was not valid JSON: {response.text}")
-        return run_chat_agent(user_prompt, chat_history) # Fallback to chat
+    except json.JSONDecodeError as e:
+        st.error(f"Error: The agent's routing decision was not valid JSON: {e.doc}")
+        return run_chat_agent(user_prompt, history_prompt) # Fallback to chat
     except Exception as e:
         return f"An error occurred in the agent orchestrator: {e}"
 
@@ -335,9 +817,19 @@ st.set_page_config(page_title="E-Commerce AI Agent", page_icon="🛍️")
 st.title("🛍️ E-Commerce AI Agent")
 st.caption(f"Chat with your Olist dataset in `{DB_NAME}`. Powered by Gemini & Streamlit.")
 
+# Only the most recent messages are kept (and re-rendered on every rerun)
+MAX_CHAT_MESSAGES = 50
+
 # Initialize chat history in session state
 if "messages" not in st.session_state:
-    st.session_state.messages = [{"role": "assistant", "content": "Hi! How can I help you analyze the e-commerce data today?"}]
+    st.session_state.messages = deque(
+        [{"role": "assistant", "content": "Hi! How can I help you analyze the e-commerce data today?"}],
+        maxlen=MAX_CHAT_MESSAGES,
+    )
+
+# The last few messages, pre-formatted for the LLM prompts
+if "history_prompt" not in st.session_state:
+    st.session_state.history_prompt = f"Assistant: {st.session_state.messages[0]['content']}"
 
 # Display past chat messages
 for message in st.session_state.messages:
@@ -349,6 +841,7 @@ if user_prompt := st.chat_input("What's the total revenue this year?"):
     
     # Add user message to history
     st.session_state.messages.append({"role": "user", "content": user_prompt})
+    append_to_history_prompt("User", user_prompt)
     
     # Display user message
     with st.chat_message("user"):
@@ -358,10 +851,15 @@ if user_prompt := st.chat_input("What's the total revenue this year?"):
     with st.chat_message("assistant"):
         with st.spinner("Thinking..."):
             # Call the main agent orchestrator
-            response_text = get_agent_response(user_prompt, st.session_state.messages)
+            response = get_agent_response(user_prompt, st.session_state.history_prompt)
             
-            # Display the final response
-            st.markdown(response_text)
+            # Display the final response, token by token if it is streamed
+            if isinstance(response, str):
+                st.markdown(response)
+                response_text = response
+            else:
+                response_text = st.write_stream(response)
             
             # Add agent response to history
-            st.session_state.messages.append({"role": "assistant", "content": response_text})
\ No newline at end of file
+            st.session_state.messages.append({"role": "assistant", "content": response_text})
+            append_to_history_prompt("Assistant", response_text)
\ No newline at end of file
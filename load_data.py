@@ -1,12 +1,16 @@
 # load_data.py
 import pandas as pd
-from sqlalchemy import create_engine
+import pyarrow as pa
+from sqlalchemy import create_engine, text
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
+import csv
 import glob
+import json
 
 # --- CONFIGURATION ---
 # !!! **UPDATE THESE VALUES** !!!
-DB_USER = "root" 
+DB_USER = "root"
 DB_PASSWORD = "" # Your MySQL password
 DB_HOST = "localhost"
 DB_PORT = "3306"
@@ -16,30 +20,194 @@ DB_NAME = "olist_db"
 # Make sure your CSV files are in a folder named 'data' in your project directory
 # or update this path.
 CSV_FOLDER_PATH = "./"
+
+# How many tables to load at the same time (one process per table)
+MAX_WORKERS = 8
+
+# Rows per multi-row INSERT statement
+INSERT_CHUNK_SIZE = 5000
+
+# Tables bigger than this are bulk-loaded with LOAD DATA LOCAL INFILE
+LOAD_DATA_MIN_ROWS = 100_000
+
+# Rows read to infer the column types of a bulk-loaded table
+LOAD_DATA_SAMPLE_ROWS = 10_000
+
+# The app reads the table/column list from here instead of introspecting MySQL
+SCHEMA_JSON_PATH = "schema.json"
+
+# Indexes created after loading: (index name, table, column)
+INDEXES = [
+    # Used when pre-computing the map data, which groups geolocation by zip prefix
+    ("idx_geo_zip", "olist_geolocation_dataset", "geolocation_zip_code_prefix"),
+]
 # --- END CONFIGURATION ---
 
 # Create the database connection string
 connection_string = f"mysql+mysqlconnector://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-try:
-    engine = create_engine(connection_string)
-    print("Database connection successful.")
-except Exception as e:
-    print(f"Error connecting to database: {e}")
-    print("Please check your DB_USER, DB_PASSWORD, and other settings.")
-    exit()
+# LOAD DATA LOCAL INFILE must be allowed on the client side as well
+# (the server needs 'local_infile=1' too).
+connect_args = {"allow_local_infile": True}
+
+
+def insert_rows(df, table_name, engine):
+    """Writes the DataFrame to MySQL with multi-row INSERTs."""
+    # 'if_exists='replace'' will overwrite the table if it already exists.
+    # Use 'if_exists='append'' if you want to add data, or 'fail' to error.
+    # 'method='multi'' sends many rows per INSERT instead of one.
+    df.to_sql(table_name, con=engine, if_exists='replace', index=False,
+              method='multi', chunksize=INSERT_CHUNK_SIZE)
+
+
+def bulk_load_csv(csv_file, table_name, sample_df, engine):
+    """
+    Creates the table from the dtypes inferred on the first rows of the CSV,
+    then lets MySQL read the file directly. Much faster than INSERTs for big
+    tables, and the file is never fully parsed in Python.
+    """
+    # An empty frame is enough to create the table with the right column types
+    sample_df.head(0).to_sql(table_name, con=engine, if_exists='replace', index=False)
+
+    # Read each field into a variable first, so empty fields become NULL
+    # (LOAD DATA would otherwise store '' or 0)
+    variables = [f"@v{i}" for i in range(len(sample_df.columns))]
+    variable_list = ", ".join(variables)
+    assignments = ", ".join(
+        f"`{col}` = NULLIF({var}, '')" for col, var in zip(sample_df.columns, variables)
+    )
+    load_query = text(f"""
+        LOAD DATA LOCAL INFILE :csv_path
+        INTO TABLE `{table_name}`
+        FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+        LINES TERMINATED BY '\\n'
+        IGNORE 1 LINES
+        ({variable_list})
+        SET {assignments}
+    """)
+    with engine.begin() as conn:
+        conn.execute(load_query, {"csv_path": os.path.abspath(csv_file)})
+
+
+def check_row_count(engine, table_name, expected_rows):
+    """
+    Raises if the table doesn't hold the expected number of rows.
+    LOAD DATA LOCAL turns bad rows into warnings instead of errors, so a
+    load that "succeeded" can still have skipped or merged rows.
+    """
+    with engine.connect() as conn:
+        row_count = conn.execute(text(f"SELECT COUNT(*) FROM `{table_name}`")).scalar()
+    if row_count != expected_rows:
+        raise ValueError(f"table has {row_count} rows, expected {expected_rows}")
+
+
+def create_indexes(engine):
+    """Adds the indexes in INDEXES once all tables have been (re)created."""
+    for index_name, table_name, column in INDEXES:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"CREATE INDEX `{index_name}` ON `{table_name}` (`{column}`)"))
+            print(f"  Created index '{index_name}' on '{table_name}'.")
+        except Exception as e:
+            print(f"  Error creating index '{index_name}' on '{table_name}': {e}")
+
+
+def create_customer_locations(engine):
+    """
+    Pre-computes the app's map data: the number of customers per ~0.1 degree
+    cell. Geolocation has many rows per zip prefix, so it is first collapsed
+    to one average point per prefix; otherwise each customer would be
+    counted once per geolocation row. The app reads this small table
+    instead of running the join on every map request.
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS `olist_customer_locations`"))
+            conn.execute(text("""
+                CREATE TABLE `olist_customer_locations` AS
+                SELECT
+                    ROUND(geo.lat, 1) AS lat,
+                    ROUND(geo.lng, 1) AS lon,
+                    COUNT(*) AS n
+                FROM
+                    `olist_customers_dataset` c
+                JOIN (
+                    SELECT
+                        geolocation_zip_code_prefix,
+                        AVG(geolocation_lat) AS lat,
+                        AVG(geolocation_lng) AS lng
+                    FROM `olist_geolocation_dataset`
+                    GROUP BY geolocation_zip_code_prefix
+                ) geo
+                ON
+                    c.customer_zip_code_prefix = geo.geolocation_zip_code_prefix
+                GROUP BY 1, 2
+            """))
+            row_count = conn.execute(text("SELECT COUNT(*) FROM `olist_customer_locations`")).scalar()
+        print(f"  Created table 'olist_customer_locations' with {row_count} rows.")
+    except Exception as e:
+        print(f"  Error creating table 'olist_customer_locations': {e}")
+
+
+def dump_schema(engine):
+    """
+    Saves every table's column names to SCHEMA_JSON_PATH for app.py.
+    The pre-computed map table is left out: it isn't Olist data, so the SQL
+    agent shouldn't query it.
+    """
+    schema_query = text("""
+        SELECT TABLE_NAME, COLUMN_NAME
+        FROM information_schema.columns
+        WHERE TABLE_SCHEMA = :db AND TABLE_NAME <> 'olist_customer_locations'
+        ORDER BY TABLE_NAME, ORDINAL_POSITION
+    """)
+    schema_info = {}
+    with engine.connect() as conn:
+        for table, column in conn.execute(schema_query, {"db": DB_NAME}):
+            schema_info.setdefault(table, []).append(column)
 
-# Find all CSV files in the specified folder
-csv_files = glob.glob(os.path.join(CSV_FOLDER_PATH, "*.csv"))
+    with open(SCHEMA_JSON_PATH, "w") as f:
+        json.dump(schema_info, f, indent=2)
+    print(f"  Saved the schema of {len(schema_info)} tables to '{SCHEMA_JSON_PATH}'.")
 
-if not csv_files:
-    print(f"No CSV files found in '{CSV_FOLDER_PATH}'.")
-    print("Please make sure your CSV files are in the correct directory.")
-    exit()
 
-print(f"Found {len(csv_files)} CSV files. Starting data load...")
+def count_csv_rows(csv_file):
+    """
+    Counts the data rows of a CSV file without building a DataFrame.
+    Uses the csv module rather than a raw line count, so quoted values
+    that contain newlines still count as one row.
+    """
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        return sum(1 for _ in csv.reader(f)) - 1  # minus the header
 
-for csv_file in csv_files:
+
+def clean_columns(df):
+    """Cleans column names (removes quotes, etc.)."""
+    df.columns = df.columns.str.strip().str.strip('"')
+    return df
+
+
+def read_csv(csv_file):
+    """
+    Reads a CSV file with the multithreaded pyarrow parser into
+    pyarrow-backed columns, which use far less memory than object strings.
+    pyarrow can't parse quoted values that contain newlines (the review
+    comments do), so those files fall back to the C parser, still with
+    pyarrow-backed columns.
+    """
+    try:
+        return pd.read_csv(csv_file, engine='pyarrow', dtype_backend='pyarrow')
+    except (pa.ArrowInvalid, pd.errors.ParserError):
+        # pandas usually re-raises pyarrow's parse error as a ParserError
+        return pd.read_csv(csv_file, dtype_backend='pyarrow')
+
+
+def load_one(csv_file):
+    """
+    Loads a single CSV file into its own MySQL table.
+    Runs in a worker process, so it creates its own engine
+    (SQLAlchemy engines must not be shared across processes).
+    """
     # Extract a clean table name from the file name
     # e.g., 'olist_customers_dataset.csv' -> 'olist_customers_dataset'
     table_name = os.path.basename(csv_file).replace('.csv', '')
@@ -47,23 +215,81 @@ for csv_file in csv_files:
     print(f"\nProcessing {csv_file} -> table '{table_name}'...")
 
     try:
-        # Read the CSV file into a pandas DataFrame
-        df = pd.read_csv(csv_file)
-
-        # Clean column names (remove quotes, etc.)
-        df.columns = df.columns.str.strip().str.strip('"')
+        engine = create_engine(connection_string, connect_args=connect_args)
 
-        print(f"  Read {len(df)} rows. Columns: {list(df.columns)}")
+        row_count = count_csv_rows(csv_file)
 
-        # Write the DataFrame to the MySQL database
-        # 'if_exists='replace'' will overwrite the table if it already exists.
-        # Use 'if_exists='append'' if you want to add data, or 'fail' to error.
-        df.to_sql(table_name, con=engine, if_exists='replace', index=False)
+        if row_count > LOAD_DATA_MIN_ROWS:
+            # Big tables skip pandas' INSERTs and are bulk-loaded by MySQL;
+            # a sample of the rows is enough to pick the column types
+            sample_df = clean_columns(pd.read_csv(csv_file, nrows=LOAD_DATA_SAMPLE_ROWS))
+            print(f"  Found {row_count} rows for '{table_name}'. Columns: {list(sample_df.columns)}")
+            try:
+                bulk_load_csv(csv_file, table_name, sample_df, engine)
+                check_row_count(engine, table_name, row_count)
+            except Exception as e:
+                # e.g. the server has local_infile=OFF (the MySQL 8 default)
+                print(f"  LOAD DATA failed for '{table_name}' ({e}). Falling back to INSERTs...")
+                insert_rows(clean_columns(read_csv(csv_file)), table_name, engine)
+                check_row_count(engine, table_name, row_count)
+        else:
+            # Read the CSV file into a pandas DataFrame
+            df = clean_columns(read_csv(csv_file))
+            print(f"  Read {len(df)} rows for '{table_name}'. Columns: {list(df.columns)}")
+            insert_rows(df, table_name, engine)
+            check_row_count(engine, table_name, len(df))
+        engine.dispose()
 
         print(f"  Successfully loaded data into table '{table_name}'.")
+        return True
 
     except Exception as e:
         print(f"  Error processing file {csv_file}: {e}")
+        return False
+
+
+def main():
+    try:
+        engine = create_engine(connection_string)
+        with engine.connect():
+            pass
+        # Close the pooled connection so forked workers don't inherit it;
+        # the engine opens a fresh one for the post-load steps below
+        engine.dispose()
+        print("Database connection successful.")
+    except Exception as e:
+        print(f"Error connecting to database: {e}")
+        print("Please check your DB_USER, DB_PASSWORD, and other settings.")
+        exit()
+
+    # Find all CSV files in the specified folder
+    csv_files = glob.glob(os.path.join(CSV_FOLDER_PATH, "*.csv"))
+
+    if not csv_files:
+        print(f"No CSV files found in '{CSV_FOLDER_PATH}'.")
+        print("Please make sure your CSV files are in the correct directory.")
+        exit()
+
+    print(f"Found {len(csv_files)} CSV files. Starting data load...")
+
+    # Tables are independent, so load them concurrently
+    with ProcessPoolExecutor(max_workers=min(MAX_WORKERS, len(csv_files))) as executor:
+        futures = [executor.submit(load_one, csv_file) for csv_file in csv_files]
+        results = [future.result() for future in as_completed(futures)]
+
+    print("\nCreating indexes...")
+    create_indexes(engine)
+
+    print("\nPre-computing map data...")
+    create_customer_locations(engine)
+
+    print("\nSaving schema...")
+    dump_schema(engine)
+    engine.dispose()
+
+    print("\n--- Data loading complete! ---")
+    print(f"{sum(results)} of {len(csv_files)} CSV files have been loaded into the '{DB_NAME}' database.")
+
 
-print("\n--- Data loading complete! ---")
-print(f"All CSV files have been loaded into the '{DB_NAME}' database.")
+if __name__ == "__main__":
+    main()